@@ -1,30 +1,26 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 
 
+import functools
 import json
 import os
 import sys
-from urllib.parse import urlencode
+from urllib.parse import parse_qsl, urlencode
 
-import astropy.units as u
-from astropy.io.ascii import write as ap_write
-from astroquery.utils.commons import parse_coordinates
-from astropy.table import Table as AstroTable
-import numpy as np
-import pkg_resources
 import pytest
-import requests
 try:
     pyvo_OK = True
     from pyvo.auth import authsession
 except ImportError:
     pyvo_OK = False
     pytest.skip("Install pyvo for the nasa_exoplanet_archive module.", allow_module_level=True)
+
+import astropy.units as u
+import requests
 from astropy.coordinates import SkyCoord
-from astropy.tests.helper import assert_quantity_allclose
 from astropy.utils.exceptions import AstropyDeprecationWarning
 
-from ...exceptions import InputWarning, InvalidQueryError, NoResultsWarning
+from ...exceptions import NoResultsWarning
 from ...utils.testing_tools import MockResponse
 from ..core import NasaExoplanetArchive, conf, InvalidTableError
 try:
@@ -32,33 +28,38 @@ try:
 except ImportError:
     pytest.skip("Install mock for the nasa_exoplanet_archive tests.", allow_module_level=True)
 
-MAIN_DATA = pkg_resources.resource_filename("astroquery.nasa_exoplanet_archive", "data")
-TEST_DATA = pkg_resources.resource_filename(__name__, "data")
+TEST_DATA = os.path.join(os.path.dirname(__file__), "data")
 RESPONSE_FILE = os.path.join(TEST_DATA, "responses.json")
 
+# The TOI table cannot be loaded on Windows
+_WIN = sys.platform.startswith("win")
+
+# Query shared by all the Kepler KOI, TCE and stellar tables
+_KEPID_WHERE = dict(where="kepid=10601284")
+
 # API accessible tables will gradually transition to TAP service
 # Check https://exoplanetarchive.ipac.caltech.edu/docs/TAP/usingTAP.html for an up-to-date list
 API_TABLES = [
-    ("cumulative", dict(where="kepid=10601284")),
-    ("koi", dict(where="kepid=10601284")),
-    ("q1_q17_dr25_sup_koi", dict(where="kepid=10601284")),
-    ("q1_q17_dr25_koi", dict(where="kepid=10601284")),
-    ("q1_q17_dr24_koi", dict(where="kepid=10601284")),
-    ("q1_q16_koi", dict(where="kepid=10601284")),
-    ("q1_q12_koi", dict(where="kepid=10601284")),
-    ("q1_q8_koi", dict(where="kepid=10601284")),
-    ("q1_q6_koi", dict(where="kepid=10601284")),
-    ("tce", dict(where="kepid=10601284")),
-    ("q1_q17_dr25_tce", dict(where="kepid=10601284")),
-    ("q1_q17_dr24_tce", dict(where="kepid=10601284")),
-    ("q1_q16_tce", dict(where="kepid=10601284")),
-    ("q1_q12_tce", dict(where="kepid=10601284")),
-    ("keplerstellar", dict(where="kepid=10601284")),
-    ("q1_q17_dr25_supp_stellar", dict(where="kepid=10601284")),
-    ("q1_q17_dr25_stellar", dict(where="kepid=10601284")),
-    ("q1_q17_dr24_stellar", dict(where="kepid=10601284")),
-    ("q1_q16_stellar", dict(where="kepid=10601284")),
-    ("q1_q12_stellar", dict(where="kepid=10601284")),
+    ("cumulative", _KEPID_WHERE),
+    ("koi", _KEPID_WHERE),
+    ("q1_q17_dr25_sup_koi", _KEPID_WHERE),
+    ("q1_q17_dr25_koi", _KEPID_WHERE),
+    ("q1_q17_dr24_koi", _KEPID_WHERE),
+    ("q1_q16_koi", _KEPID_WHERE),
+    ("q1_q12_koi", _KEPID_WHERE),
+    ("q1_q8_koi", _KEPID_WHERE),
+    ("q1_q6_koi", _KEPID_WHERE),
+    ("tce", _KEPID_WHERE),
+    ("q1_q17_dr25_tce", _KEPID_WHERE),
+    ("q1_q17_dr24_tce", _KEPID_WHERE),
+    ("q1_q16_tce", _KEPID_WHERE),
+    ("q1_q12_tce", _KEPID_WHERE),
+    ("keplerstellar", _KEPID_WHERE),
+    ("q1_q17_dr25_supp_stellar", _KEPID_WHERE),
+    ("q1_q17_dr25_stellar", _KEPID_WHERE),
+    ("q1_q17_dr24_stellar", _KEPID_WHERE),
+    ("q1_q16_stellar", _KEPID_WHERE),
+    ("q1_q12_stellar", _KEPID_WHERE),
     ("keplertimeseries", dict(kepid=8561063, quarter=14)),
     ("kelttimeseries", dict(where="kelt_sourceid='KELT_N02_lc_012738_V01_east'", kelt_field="N02")),
     ("kelt", dict(where="kelt_sourceid='KELT_N02_lc_012738_V01_east'", kelt_field="N02")),
@@ -67,55 +68,124 @@ API_TABLES = [
     ("k2candidates", dict(where="epic_name='EPIC 206027655'")),
     ("missionstars", dict(where="star_name='tau Cet'")),
     ("mission_exocat", dict(where="star_name='HIP 5110 A'")),
-    pytest.param(
-        "toi",
-        dict(where="toi=256.01"),
-        marks=pytest.mark.skipif(
-            sys.platform.startswith("win"), reason="TOI table cannot be loaded on Windows"
-        ),
-    ),
+    ("toi", dict(where="toi=256.01")),
 ]
 
 
-def mock_get(self, method, url, *args, **kwargs):  # pragma: nocover
-    assert url == conf.url_api
+# Parsed contents of RESPONSE_FILE, shared between mocked requests and only
+# re-read when the file changes on disk. _KEY_INDEX maps each table to a
+# {key: index} dict so that lookups don't have to scan the list of keys; its
+# keys are the sorted (name, value) pairs of the request parameters rather
+# than the urlencoded strings that are saved in RESPONSE_FILE.
+# Newly generated responses only mark the cache as dirty, and it is written
+# back to RESPONSE_FILE once at the end of the test session.
+_RESPONSES_CACHE = None
+_RESPONSES_MTIME = None
+_RESPONSES_DIRTY = False
+_KEY_INDEX = {}
 
-    params = kwargs.get("params", None)
-    assert params is not None
+# Contents of the saved {table}_expect_{index}.txt files, keyed by (table, index). They are
+# all read by load_responses whenever it (re)loads RESPONSE_FILE.
+_FIXTURE_BYTES = {}
 
-    try:
-        with open(RESPONSE_FILE, "r") as f:
-            responses = json.load(f)
-    except FileNotFoundError:
-        responses = {}
+# When generating the expected responses, all the remote requests go through one session so
+# that the connection to the archive is kept alive between them. It is created on the first
+# request that has to be generated, and closed at the end of the test session.
+_GEN_SESSION = None
+
+
+def load_responses():  # pragma: nocover
+    global _RESPONSES_CACHE, _RESPONSES_MTIME, _KEY_INDEX
 
-    # Work out where the expected response is saved
-    table = params["table"]
-    key = urlencode(sorted(params.items()))
     try:
-        index = responses.get(table, []).index(key)
-    except ValueError:
-        index = -1
-
-    # If the NASA_EXOPLANET_ARCHIVE_GENERATE_RESPONSES environment variable is set, we make a
-    # remote request if necessary. Otherwise we throw a ValueError.
-    if index < 0:
-        if "NASA_EXOPLANET_ARCHIVE_GENERATE_RESPONSES" not in os.environ:
-            raise ValueError("unexpected request")
-        with requests.Session() as session:
-            resp = session.old_request(method, url, params=params)
-        responses[table] = responses.get(table, [])
-        responses[table].append(key)
-        index = len(responses[table]) - 1
-        with open(os.path.join(TEST_DATA, "{0}_expect_{1}.txt".format(table, index)), "w") as f:
-            f.write(resp.text)
-        with open(RESPONSE_FILE, "w") as f:
-            json.dump(responses, f, sort_keys=True, indent=2)
-
-    with open(os.path.join(TEST_DATA, "{0}_expect_{1}.txt".format(table, index)), "r") as f:
-        data = f.read()
-
-    return MockResponse(data.encode("utf-8"))
+        mtime = os.path.getmtime(RESPONSE_FILE)
+    except FileNotFoundError:
+        mtime = None
+
+    if _RESPONSES_CACHE is None or mtime != _RESPONSES_MTIME:
+        if mtime is None:
+            _RESPONSES_CACHE = {}
+        else:
+            with open(RESPONSE_FILE, "r") as f:
+                _RESPONSES_CACHE = json.load(f)
+        _RESPONSES_MTIME = mtime
+        _KEY_INDEX = {table: {tuple(parse_qsl(key, keep_blank_values=True)): index
+                              for index, key in enumerate(keys)}
+                      for table, keys in _RESPONSES_CACHE.items()}
+        # The indices may now point at different files, so reload the saved bodies too and
+        # drop the responses cached for the old indices
+        _FIXTURE_BYTES.clear()
+        load_fixture_bytes(_RESPONSES_CACHE)
+        mock_response.cache_clear()
+
+    return _RESPONSES_CACHE
+
+
+def save_responses():  # pragma: nocover
+    global _RESPONSES_MTIME, _RESPONSES_DIRTY
+
+    if not _RESPONSES_DIRTY:
+        return
+
+    with open(RESPONSE_FILE, "w") as f:
+        json.dump(_RESPONSES_CACHE, f, sort_keys=True, indent=2)
+    _RESPONSES_MTIME = os.path.getmtime(RESPONSE_FILE)
+    _RESPONSES_DIRTY = False
+
+
+def load_fixture_bytes(responses):  # pragma: nocover
+    # Only the files listed in RESPONSE_FILE can be served, so read exactly those
+    for table, keys in responses.items():
+        for index in range(len(keys)):
+            with open(os.path.join(TEST_DATA, "{0}_expect_{1}.txt".format(table, index)), "rb") as f:
+                _FIXTURE_BYTES[table, index] = f.read()
+
+
+@functools.lru_cache(maxsize=None)
+def mock_response(table, index):  # pragma: nocover
+    # The only attribute the code under test sets on a response is requested_format, which
+    # is the same for every request that maps to a given (table, index), so they can be reused
+    return MockResponse(_FIXTURE_BYTES[table, index])
+
+
+def make_mock_get(url_api):  # pragma: nocover
+    # The API URL is looked up once, when the session is patched, rather than on every request
+    def mock_get(self, method, url, *args, **kwargs):
+        global _RESPONSES_DIRTY, _GEN_SESSION
+
+        assert url == url_api
+
+        params = kwargs.get("params", None)
+        assert params is not None
+
+        responses = load_responses()
+
+        # Work out where the expected response is saved
+        table = params["table"]
+        key = tuple(sorted((name, str(value)) for name, value in params.items()))
+        index = _KEY_INDEX.get(table, {}).get(key, -1)
+
+        # If the NASA_EXOPLANET_ARCHIVE_GENERATE_RESPONSES environment variable is set, we make a
+        # remote request if necessary. Otherwise we throw a ValueError.
+        if index < 0:
+            if "NASA_EXOPLANET_ARCHIVE_GENERATE_RESPONSES" not in os.environ:
+                raise ValueError("unexpected request")
+            if _GEN_SESSION is None:
+                _GEN_SESSION = requests.Session()
+            resp = _GEN_SESSION.old_request(method, url, params=params)
+            responses[table] = responses.get(table, [])
+            responses[table].append(urlencode(key))
+            index = len(responses[table]) - 1
+            _KEY_INDEX.setdefault(table, {})[key] = index
+            payload = resp.text.encode("utf-8")
+            with open(os.path.join(TEST_DATA, "{0}_expect_{1}.txt".format(table, index)), "wb") as f:
+                f.write(payload)
+            _FIXTURE_BYTES[table, index] = payload
+            _RESPONSES_DIRTY = True
+
+        return mock_response(table, index)
+
+    return mock_get
 
 
 @pytest.fixture
@@ -125,14 +195,41 @@ def patch_get(request):  # pragma: nocover
     except AttributeError:
         mp = request.getfuncargvalue("monkeypatch")
 
-    # Keep track of the original function so that we can use it to generate the expected responses
-    requests.Session.old_request = requests.Session.request
-    mp.setattr(requests.Session, "request", mock_get)
+    # Keep track of the original function so that we can use it to generate the expected responses.
+    # This also goes through monkeypatch so that requests.Session is left untouched after the test.
+    mp.setattr(requests.Session, "old_request", requests.Session.request, raising=False)
+    mp.setattr(requests.Session, "request", make_mock_get(conf.url_api))
     return mp
 
 
+@pytest.fixture(scope="session", autouse=True)
+def flush_responses():  # pragma: nocover
+    yield
+    save_responses()
+    if _GEN_SESSION is not None:
+        _GEN_SESSION.close()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def tap_tables():  # pragma: nocover
+    # Avoid looking up the list of TAP tables on the remote server, and restore the
+    # original value afterwards so it doesn't leak into other test modules
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(NasaExoplanetArchive, "_tap_tables", ['list'], raising=False)
+        yield
+
+
+@pytest.fixture(scope="session")
+def archive():
+    return NasaExoplanetArchive()
+
+
+@pytest.fixture(scope="session")
+def coords():
+    return SkyCoord(ra=172.56 * u.deg, dec=7.59 * u.deg)
+
+
 def test_regularize_object_name(patch_get):
-    NasaExoplanetArchive._tap_tables = ['list']
     assert NasaExoplanetArchive._regularize_object_name("kepler 2") == "HAT-P-7"
     assert NasaExoplanetArchive._regularize_object_name("kepler 1 b") == "TrES-2 b"
 
@@ -146,7 +243,6 @@ def test_backwards_compat(patch_get):
     These are the tests from the previous version of this interface.
     They query old tables by default and should return InvalidTableError.
     """
-    NasaExoplanetArchive._tap_tables = ['list']
 
     # test_hd209458b_exoplanets_archive
     with pytest.warns(AstropyDeprecationWarning):
@@ -180,24 +276,27 @@ def test_backwards_compat(patch_get):
 
 
 @pytest.mark.filterwarnings("error")
-@pytest.mark.parametrize("table,query", API_TABLES)
-def test_api_tables(patch_get, table, query):
-    NasaExoplanetArchive._tap_tables = ['list']
-    data = NasaExoplanetArchive.query_criteria(table, select="*", **query)
-    assert len(data) > 0
+def test_api_tables(patch_get):
+    # All the tables are queried in a single test, so that the mocked session is only set up once
+    for table, query in API_TABLES:
+        if table == "toi" and _WIN:
+            continue
+
+        data = NasaExoplanetArchive.query_criteria(table, select="*", **query)
+        assert len(data) > 0, table
 
-    # Check that the units were fixed properly
-    for col in data.columns:
-        assert isinstance(data[col], SkyCoord) or not isinstance(data[col].unit, u.UnrecognizedUnit)
+        # Check that the units were fixed properly, reporting all the bad columns at once
+        bad_columns = [col for col in data.colnames
+                       if not isinstance(data[col], SkyCoord)
+                       and isinstance(data[col].unit, u.UnrecognizedUnit)]
+        assert not bad_columns, "{0}: {1}".format(table, bad_columns)
 
 
 # Mock tests on TAP service below
 @patch('astroquery.nasa_exoplanet_archive.core.get_access_url',
        Mock(side_effect=lambda x: 'https://some.url'))
 @pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
-def test_query_object():
-    nasa_exoplanet_archive = NasaExoplanetArchive()
-
+def test_query_object(monkeypatch, archive):
     def mock_run_query(object_name="K2-18 b", table="pscomppars", select="pl_name,disc_year,discoverymethod,ra,dec"):
         assert object_name == "K2-18 b"
         assert table == "pscomppars"
@@ -206,8 +305,8 @@ def test_query_object():
         result = {'pl_name': 'K2-18 b', 'disc_year': 2015, 'discoverymethod': 'Transit', 'ra': [172.560141] * u.deg, 'dec': [7.5878315] * u.deg}
 
         return result
-    nasa_exoplanet_archive.query_object = mock_run_query
-    response = nasa_exoplanet_archive.query_object()
+    monkeypatch.setattr(archive, "query_object", mock_run_query)
+    response = archive.query_object()
     assert response['pl_name'] == 'K2-18 b'
     assert response['disc_year'] == 2015
     assert 'Transit' in response['discoverymethod']
@@ -218,27 +317,23 @@ def test_query_object():
 @patch('astroquery.nasa_exoplanet_archive.core.get_access_url',
        Mock(side_effect=lambda x: 'https://some.url'))
 @pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
-def test_query_region():
-    nasa_exoplanet_archive = NasaExoplanetArchive()
-
-    def mock_run_query(table="ps", select='pl_name,ra,dec', coordinates=SkyCoord(ra=172.56 * u.deg, dec=7.59 * u.deg), radius=1.0 * u.deg):
+def test_query_region(monkeypatch, archive, coords):
+    def mock_run_query(table="ps", select='pl_name,ra,dec', coordinates=coords, radius=1.0 * u.deg):
         assert table == "ps"
         assert select == 'pl_name,ra,dec'
         assert radius == 1.0 * u.deg
         result = PropertyMock()
         result = {'pl_name': 'K2-18 b'}
         return result
-    nasa_exoplanet_archive.query_region = mock_run_query
-    response = nasa_exoplanet_archive.query_region()
+    monkeypatch.setattr(archive, "query_region", mock_run_query)
+    response = archive.query_region()
     assert 'K2-18 b' in response['pl_name']
 
 
 @patch('astroquery.nasa_exoplanet_archive.core.get_access_url',
        Mock(side_effect=lambda x: 'https://some.url'))
 @pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
-def test_query_criteria():
-    nasa_exoplanet_archive = NasaExoplanetArchive()
-
+def test_query_criteria(monkeypatch, archive):
     def mock_run_query(table="ps", select='pl_name,discoverymethod,dec', where="discoverymethod like 'Microlensing' and dec > 0"):
         assert table == "ps"
         assert select == "pl_name,discoverymethod,dec"
@@ -246,8 +341,8 @@ def test_query_criteria():
         result = PropertyMock()
         result = {'pl_name': 'TCP J05074264+2447555 b', 'discoverymethod': 'Microlensing', 'dec': [24.7987499] * u.deg}
         return result
-    nasa_exoplanet_archive.query_criteria = mock_run_query
-    response = nasa_exoplanet_archive.query_criteria()
+    monkeypatch.setattr(archive, "query_criteria", mock_run_query)
+    response = archive.query_criteria()
     assert 'TCP J05074264+2447555 b' in response['pl_name']
     assert 'Microlensing' in response['discoverymethod']
     assert response['dec'] == [24.7987499] * u.deg
@@ -256,9 +351,7 @@ def test_query_criteria():
 @patch('astroquery.nasa_exoplanet_archive.core.get_access_url',
        Mock(side_effect=lambda x: 'https://some.url'))
 @pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
-def test_get_query_payload():
-    nasa_exoplanet_archive = NasaExoplanetArchive()
-
+def test_get_query_payload(monkeypatch, archive):
     def mock_run_query(table="ps", get_query_payload=True, select="count(*)", where="disc_facility like '%TESS%'"):
         assert table == "ps"
         assert get_query_payload
@@ -267,8 +360,8 @@ def test_get_query_payload():
         result = PropertyMock()
         result = {'table': 'ps', 'select': 'count(*)', 'where': "disc_facility like '%TESS%'", 'format': 'ipac'}
         return result
-    nasa_exoplanet_archive.query_criteria = mock_run_query
-    response = nasa_exoplanet_archive.query_criteria()
+    monkeypatch.setattr(archive, "query_criteria", mock_run_query)
+    response = archive.query_criteria()
     assert 'ps' in response['table']
     assert 'count(*)' in response['select']
     assert "disc_facility like '%TESS%'" in response['where']
@@ -277,9 +370,7 @@ def test_get_query_payload():
 @patch('astroquery.nasa_exoplanet_archive.core.get_access_url',
        Mock(side_effect=lambda x: 'https://some.url'))
 @pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
-def test_select():
-    nasa_exoplanet_archive = NasaExoplanetArchive()
-
+def test_select(monkeypatch, archive):
     def mock_run_query(table="ps", select=["hostname", "pl_name"], where="hostname='Kepler-11'", get_query_payload=True):
         assert table == "ps"
         assert select == ["hostname", "pl_name"]
@@ -288,23 +379,21 @@ def test_select():
         payload = PropertyMock()
         payload = {'table': 'ps', 'select': 'hostname,pl_name', 'where': "hostname='Kepler-11'", 'format': 'ipac'}
         return payload
-    nasa_exoplanet_archive.query_criteria = mock_run_query
-    payload = nasa_exoplanet_archive.query_criteria()
+    monkeypatch.setattr(archive, "query_criteria", mock_run_query)
+    payload = archive.query_criteria()
     assert payload["select"] == "hostname,pl_name"
 
 
 @patch('astroquery.nasa_exoplanet_archive.core.get_access_url',
        Mock(side_effect=lambda x: 'https://some.url'))
 @pytest.mark.skipif(not pyvo_OK, reason='not pyvo_OK')
-def test_get_tap_tables():
-    nasa_exoplanet_archive = NasaExoplanetArchive()
-
+def test_get_tap_tables(monkeypatch, archive):
     def mock_run_query(url=conf.url_tap):
         assert url == conf.url_tap
         result = PropertyMock()
         result = ['transitspec', 'emissionspec', 'ps', 'pscomppars', 'keplernames', 'k2names']
         return result
-    nasa_exoplanet_archive.get_tap_tables = mock_run_query
-    result = nasa_exoplanet_archive.get_tap_tables()
+    monkeypatch.setattr(archive, "get_tap_tables", mock_run_query)
+    result = archive.get_tap_tables()
     assert 'ps' in result
     assert 'pscomppars' in result